@@ -44,6 +44,7 @@ public class RabbitMQConfig {
     public static final String DEVICE_EXCHANGE = "device-exchange";
     public static final String DEVICE_CREATE_QUEUE = "device.create.queue";
     public static final String DEVICE_DELETE_QUEUE = "device.delete.queue";
+    public static final String DEVICE_MAPPING_QUEUE = "device.mapping.queue";
 
     @Bean
     public TopicExchange deviceExchange() {
@@ -60,6 +61,11 @@ public class RabbitMQConfig {
         return new Queue(DEVICE_DELETE_QUEUE);
     }
 
+    @Bean
+    public Queue deviceMappingQueue() {
+        return new Queue(DEVICE_MAPPING_QUEUE);
+    }
+
     @Bean
     public Binding bindingDeviceCreate(Queue deviceCreateQueue, TopicExchange deviceExchange) {
         return BindingBuilder.bind(deviceCreateQueue).to(deviceExchange).with("device.create");
@@ -69,4 +75,9 @@ public class RabbitMQConfig {
     public Binding bindingDeviceDelete(Queue deviceDeleteQueue, TopicExchange deviceExchange) {
         return BindingBuilder.bind(deviceDeleteQueue).to(deviceExchange).with("device.delete");
     }
+
+    @Bean
+    public Binding bindingDeviceMapping(Queue deviceMappingQueue, TopicExchange deviceExchange) {
+        return BindingBuilder.bind(deviceMappingQueue).to(deviceExchange).with("device.mapping.*");
+    }
 }
@@ -2,6 +2,7 @@ package com.example.demo.controllers;
 
 import com.example.demo.dtos.DeviceDTO;
 import com.example.demo.dtos.DeviceDetailsDTO;
+import com.example.demo.dtos.builders.DeviceBuilder;
 import com.example.demo.entities.Device;
 import com.example.demo.entities.UserDeviceMapping;
 import com.example.demo.services.DeviceService;
@@ -59,7 +60,7 @@ public class DeviceController {
         UUID id = deviceService.insert(device);
 
         // Publish device create event for synchronization
-        rabbitTemplate.convertAndSend("device-exchange", "device.create", id.toString());
+        rabbitTemplate.convertAndSend("device-exchange", "device.create", DeviceBuilder.toSyncMessage(id, device.getConsumption()));
 
         URI location = ServletUriComponentsBuilder
                 .fromCurrentRequest()
@@ -92,6 +93,10 @@ public class DeviceController {
             @PathVariable UUID id, @RequestHeader("Authorization") String authHeader) {
         checkAdminRole(authHeader);
         DeviceDetailsDTO deviceDTO = deviceService.update(deviceDetailsDTO);
+
+        // Re-publish the device so monitoring picks up the new consumption limit
+        rabbitTemplate.convertAndSend("device-exchange", "device.create",
+                DeviceBuilder.toSyncMessage(deviceDTO.getId(), deviceDTO.getConsumption()));
         if (id.equals(deviceDTO.getId())) {
             return ResponseEntity.status(204).body(deviceDTO);
         } else {
@@ -109,6 +114,8 @@ public class DeviceController {
             @RequestHeader("Authorization") String authHeader) {
         checkAdminRole(authHeader);
         deviceService.assignDeviceToUser(userId, deviceId);
+        rabbitTemplate.convertAndSend("device-exchange", "device.mapping.assign",
+                DeviceBuilder.toMappingSyncMessage(userId, deviceId, "assign"));
         return ResponseEntity.status(HttpStatus.CREATED).build();
     }
 
@@ -117,6 +124,8 @@ public class DeviceController {
             @RequestHeader("Authorization") String authHeader) {
         checkAdminRole(authHeader);
         deviceService.unassignDeviceFromUser(userId, deviceId);
+        rabbitTemplate.convertAndSend("device-exchange", "device.mapping.unassign",
+                DeviceBuilder.toMappingSyncMessage(userId, deviceId, "unassign"));
         return ResponseEntity.status(HttpStatus.NO_CONTENT).build();
     }
 
@@ -4,6 +4,8 @@ import com.example.demo.dtos.DeviceDTO;
 import com.example.demo.dtos.DeviceDetailsDTO;
 import com.example.demo.entities.Device;
 
+import java.util.UUID;
+
 public class DeviceBuilder {
 
     private DeviceBuilder() {
@@ -17,6 +19,14 @@ public class DeviceBuilder {
         return new DeviceDetailsDTO(device.getId(), device.getName(), device.getManufacturer(), device.getConsumption());
     }
 
+    public static String toSyncMessage(UUID id, int consumption) {
+        return "{\"id\":\"" + id + "\",\"consumption\":" + consumption + "}";
+    }
+
+    public static String toMappingSyncMessage(UUID userId, UUID deviceId, String action) {
+        return "{\"userId\":\"" + userId + "\",\"deviceId\":\"" + deviceId + "\",\"action\":\"" + action + "\"}";
+    }
+
     public static Device toEntity(DeviceDetailsDTO deviceDetailsDTO) {
         return new Device(deviceDetailsDTO.getName(),
                 deviceDetailsDTO.getManufacturer(),
@@ -1,12 +1,15 @@
 package com.example.demo.services;
 
+import com.example.demo.dtos.builders.DeviceBuilder;
 import com.example.demo.entities.User;
 import com.example.demo.repositories.UserRepository;
 import org.slf4j.Logger;
 import org.slf4j.LoggerFactory;
 import org.springframework.amqp.rabbit.annotation.RabbitListener;
+import org.springframework.amqp.rabbit.core.RabbitTemplate;
 import org.springframework.stereotype.Service;
 
+import java.util.List;
 import java.util.UUID;
 
 @Service
@@ -15,10 +18,12 @@ public class DeviceConsumer {
     private static final Logger LOGGER = LoggerFactory.getLogger(DeviceConsumer.class);
     private final DeviceService deviceService;
     private final UserRepository userRepository;
+    private final RabbitTemplate rabbitTemplate;
 
-    public DeviceConsumer(DeviceService deviceService, UserRepository userRepository) {
+    public DeviceConsumer(DeviceService deviceService, UserRepository userRepository, RabbitTemplate rabbitTemplate) {
         this.deviceService = deviceService;
         this.userRepository = userRepository;
+        this.rabbitTemplate = rabbitTemplate;
     }
 
     @RabbitListener(queues = "user.create.device-queue")
@@ -64,7 +69,11 @@ public class DeviceConsumer {
             String cleanUuid = userIdStr.replaceAll("[^a-fA-F0-9\\-]", "");
             UUID userId = UUID.fromString(cleanUuid);
             // Delete user mappings first
-            deviceService.deleteMappingsByUserId(userId);
+            List<UUID> deviceIds = deviceService.deleteMappingsByUserId(userId);
+            for (UUID deviceId : deviceIds) {
+                rabbitTemplate.convertAndSend("device-exchange", "device.mapping.unassign",
+                        DeviceBuilder.toMappingSyncMessage(userId, deviceId, "unassign"));
+            }
             // Delete user from users table
             userRepository.deleteById(userId);
             LOGGER.info("Deleted user {} from device service database", userId);
@@ -147,9 +147,13 @@ public class DeviceService {
     }
 
     @Transactional
-    public void deleteMappingsByUserId(UUID userId) {
+    public List<UUID> deleteMappingsByUserId(UUID userId) {
         List<UserDeviceMapping> mappings = mappingRepository.findByUserId(userId);
+        List<UUID> deviceIds = mappings.stream()
+                .map(mapping -> mapping.getDevice().getId())
+                .collect(Collectors.toList());
         mappingRepository.deleteAll(mappings);
         LOGGER.debug("Deleted all mappings for user {}", userId);
+        return deviceIds;
     }
 }
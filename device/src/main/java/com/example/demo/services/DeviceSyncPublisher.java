@@ -0,0 +1,55 @@
+package com.example.demo.services;
+
+import com.example.demo.dtos.builders.DeviceBuilder;
+import com.example.demo.entities.Device;
+import com.example.demo.entities.UserDeviceMapping;
+import com.example.demo.repositories.DeviceRepository;
+import com.example.demo.repositories.UserDeviceMappingRepository;
+import jakarta.transaction.Transactional;
+import org.slf4j.Logger;
+import org.slf4j.LoggerFactory;
+import org.springframework.amqp.rabbit.core.RabbitTemplate;
+import org.springframework.boot.context.event.ApplicationReadyEvent;
+import org.springframework.context.event.EventListener;
+import org.springframework.stereotype.Service;
+
+import java.util.List;
+
+@Service
+public class DeviceSyncPublisher {
+
+    private static final Logger LOGGER = LoggerFactory.getLogger(DeviceSyncPublisher.class);
+    private final DeviceRepository deviceRepository;
+    private final UserDeviceMappingRepository mappingRepository;
+    private final RabbitTemplate rabbitTemplate;
+
+    public DeviceSyncPublisher(DeviceRepository deviceRepository, UserDeviceMappingRepository mappingRepository,
+            RabbitTemplate rabbitTemplate) {
+        this.deviceRepository = deviceRepository;
+        this.mappingRepository = mappingRepository;
+        this.rabbitTemplate = rabbitTemplate;
+    }
+
+    // Re-publish every device and user mapping on startup so monitoring learns the
+    // consumption limits and owners of devices created before they were synced
+    @EventListener(ApplicationReadyEvent.class)
+    @Transactional
+    public void publishAllDevices() {
+        try {
+            List<Device> devices = deviceRepository.findAll();
+            for (Device device : devices) {
+                rabbitTemplate.convertAndSend("device-exchange", "device.create",
+                        DeviceBuilder.toSyncMessage(device.getId(), device.getConsumption()));
+            }
+            List<UserDeviceMapping> mappings = mappingRepository.findAll();
+            for (UserDeviceMapping mapping : mappings) {
+                rabbitTemplate.convertAndSend("device-exchange", "device.mapping.assign",
+                        DeviceBuilder.toMappingSyncMessage(mapping.getUserId(), mapping.getDevice().getId(), "assign"));
+            }
+            LOGGER.info("Published {} devices and {} mappings for monitoring synchronization",
+                    devices.size(), mappings.size());
+        } catch (Exception e) {
+            LOGGER.error("Error publishing devices for monitoring synchronization", e);
+        }
+    }
+}
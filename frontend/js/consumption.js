@@ -126,6 +126,9 @@ function connectWebSocket(deviceId) {
 
                 // Optionally update the chart in real-time if the date matches today
                 // But for now, just showing current consumption is enough
+            } else if (data.type === 'alert') {
+                alert(`Device ${data.device_id} exceeded its hourly limit: ` +
+                    `${data.total_consumption.toFixed(3)} / ${data.max_consumption} kWh`);
             }
         } catch (e) {
             console.error("Error parsing WebSocket message:", e);
@@ -0,0 +1,75 @@
+import threading
+
+HOUR_MS = 3600000
+
+
+class ConsumptionAlertEngine:
+    """
+    Tracks the running consumption of the current hour for every device and
+    reports when it goes over the device's maximum hourly consumption.
+    All state lives in memory, so each reading costs O(1) dictionary work and
+    no database round-trips.
+    """
+
+    def __init__(self):
+        # device_id -> maximum hourly consumption
+        self.limits: dict[str, float] = {}
+        # device_id -> [hour, running total, alert already sent for this hour]
+        self.hourly_totals: dict[str, list] = {}
+        self.lock = threading.Lock()
+
+    def load(self, limits, hourly_totals):
+        """
+        Warm the engine on startup.
+        limits: {device_id: max_consumption}
+        hourly_totals: iterable of (device_id, hour, total_consumption) for the current hour
+        """
+        with self.lock:
+            self.limits = {str(device_id): limit for device_id, limit in limits.items() if limit is not None}
+            for device_id, hour, total in hourly_totals:
+                device_id = str(device_id)
+                limit = self.limits.get(device_id)
+                self.hourly_totals[device_id] = [hour, total, limit is not None and total > limit]
+
+    def set_limit(self, device_id, limit):
+        with self.lock:
+            if limit is None:
+                self.limits.pop(device_id, None)
+            else:
+                self.limits[device_id] = limit
+
+    def remove_device(self, device_id):
+        with self.lock:
+            self.limits.pop(device_id, None)
+            self.hourly_totals.pop(device_id, None)
+
+    def process(self, device_id, timestamp, measurement_value):
+        """
+        Add a reading to the device's running hourly total.
+        Returns an alert dictionary the first time the total exceeds the limit
+        within an hour, otherwise None.
+        """
+        hour = (timestamp // HOUR_MS) * HOUR_MS
+        with self.lock:
+            state = self.hourly_totals.get(device_id)
+            if state is None or hour > state[0]:
+                state = [hour, 0.0, False]
+                self.hourly_totals[device_id] = state
+            elif hour < state[0]:
+                # Late reading for an hour we already moved past
+                return None
+
+            state[1] += measurement_value
+            limit = self.limits.get(device_id)
+            if limit is None or state[2] or state[1] <= limit:
+                return None
+            state[2] = True
+            total = state[1]
+
+        return {
+            "type": "alert",
+            "device_id": device_id,
+            "hour": hour,
+            "total_consumption": total,
+            "max_consumption": limit
+        }
@@ -0,0 +1,250 @@
+import os
+import mmap
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/data/archive")
+
+# Each device/month segment is stored as three parallel columns:
+# <device_id>/<YYYY-MM>.ts  -> int64 timestamps (milliseconds)
+# <device_id>/<YYYY-MM>.val -> float64 measurement values
+# <device_id>/<YYYY-MM>.id  -> int64 measurement ids from Postgres
+# plus <device_id>/<YYYY-MM>.runs, the int64 start row of every appended batch.
+# Each batch is sorted by timestamp, so a range can be bisected within every run.
+# Once a segment has MAX_RUNS runs the next append rewrites it as one sorted run.
+# The rewrite goes to <file>.tmp copies that are committed by creating
+# <device_id>/<YYYY-MM>.compact and then moved into place; a crash after the
+# marker exists is rolled forward, a crash before it rolled back.
+TIMESTAMP_SUFFIX = ".ts"
+VALUE_SUFFIX = ".val"
+ID_SUFFIX = ".id"
+RUNS_SUFFIX = ".runs"
+COMPACT_SUFFIX = ".compact"
+TMP_SUFFIX = ".tmp"
+ITEM_SIZE = 8
+MAX_RUNS = int(os.getenv("ARCHIVE_MAX_RUNS", "16"))
+
+# Largest millisecond timestamp that still maps to a valid month (9999-12-31)
+MAX_TIMESTAMP = 253402300799999
+
+# Held while appending or compacting and while readers open/map a segment, never during a scan.
+_lock = threading.Lock()
+
+
+def month_key(timestamp):
+    """Return the 'YYYY-MM' segment key (UTC) for a millisecond timestamp."""
+    return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).strftime('%Y-%m')
+
+
+def _segment_paths(device_id, month):
+    base = os.path.join(ARCHIVE_DIR, str(device_id), month)
+    return base + TIMESTAMP_SUFFIX, base + VALUE_SUFFIX, base + ID_SUFFIX, base + RUNS_SUFFIX
+
+
+def _size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _row_count(column_paths):
+    return min(_size(path) for path in column_paths) // ITEM_SIZE
+
+
+def _read_column(path, typecode, count):
+    column = array(typecode)
+    if count:
+        with open(path, 'rb') as f:
+            column.fromfile(f, count)
+    return column
+
+
+def _write_column(path, typecode, values, mode):
+    with open(path, mode) as f:
+        array(typecode, values).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _append_column(path, typecode, values):
+    _write_column(path, typecode, values, 'ab')
+
+
+def _truncate(undo):
+    for path, size in undo:
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+
+def _sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _recover_segment(device_id, month):
+    """Finish or discard a compaction interrupted by a crash. Caller holds _lock."""
+    paths = _segment_paths(device_id, month)
+    marker = os.path.join(ARCHIVE_DIR, str(device_id), month) + COMPACT_SUFFIX
+    committed = os.path.exists(marker)
+    for path in paths:
+        if os.path.exists(path + TMP_SUFFIX):
+            if committed:
+                os.replace(path + TMP_SUFFIX, path)
+            else:
+                os.remove(path + TMP_SUFFIX)
+    if committed:
+        _sync_dir(os.path.dirname(marker))
+        os.remove(marker)
+
+
+def _compact_segment(device_id, month, count, new_rows):
+    """Rewrite a segment and new_rows as a single sorted run. Caller holds _lock."""
+    ts_path, val_path, id_path, runs_path = paths = _segment_paths(device_id, month)
+    rows = sorted(new_rows + list(zip(_read_column(ts_path, 'q', count),
+                                      _read_column(val_path, 'd', count),
+                                      _read_column(id_path, 'q', count))))
+    columns = (
+        (ts_path, 'q', [row[0] for row in rows]),
+        (val_path, 'd', [row[1] for row in rows]),
+        (id_path, 'q', [row[2] for row in rows]),
+        (runs_path, 'q', [0]),
+    )
+    try:
+        for path, typecode, values in columns:
+            _write_column(path + TMP_SUFFIX, typecode, values, 'wb')
+    except Exception:
+        for path in paths:
+            if os.path.exists(path + TMP_SUFFIX):
+                os.remove(path + TMP_SUFFIX)
+        raise
+
+    # Readers keep their mappings of the old files, which stay valid after the rename
+    marker = os.path.join(ARCHIVE_DIR, device_id, month) + COMPACT_SUFFIX
+    device_dir = os.path.dirname(marker)
+    _sync_dir(device_dir)
+    with open(marker, 'wb') as f:
+        os.fsync(f.fileno())
+    _sync_dir(device_dir)
+    _recover_segment(device_id, month)
+
+
+def append_segments(rows):
+    """
+    Append raw measurements to their device/month segments.
+    rows: iterable of (id, timestamp, device_id, measurement_value).
+    Appending is idempotent: ids already present in a segment are skipped, so
+    a batch whose Postgres delete did not commit can simply be archived again.
+    Returns the number of rows written.
+    """
+    grouped = {}
+    for measurement_id, timestamp, device_id, measurement_value in rows:
+        key = (str(device_id), month_key(timestamp))
+        grouped.setdefault(key, []).append((timestamp, measurement_value, measurement_id))
+
+    written = 0
+    with _lock:
+        for (device_id, month), segment_rows in grouped.items():
+            os.makedirs(os.path.join(ARCHIVE_DIR, device_id), exist_ok=True)
+            _recover_segment(device_id, month)
+            ts_path, val_path, id_path, runs_path = _segment_paths(device_id, month)
+            columns = (ts_path, val_path, id_path)
+
+            # Cut back any torn tail left by a crash so the columns stay aligned
+            count = _row_count(columns)
+            _truncate([(path, count * ITEM_SIZE) for path in columns])
+
+            archived_ids = set(_read_column(id_path, 'q', count))
+            segment_rows = sorted(row for row in segment_rows if row[2] not in archived_ids)
+            if not segment_rows:
+                continue
+
+            runs = {start for start in _read_column(runs_path, 'q', _size(runs_path) // ITEM_SIZE) if start < count}
+            if count and len(runs | {0}) >= MAX_RUNS:
+                _compact_segment(device_id, month, count, segment_rows)
+                written += len(segment_rows)
+                continue
+
+            undo = [(path, count * ITEM_SIZE) for path in columns] + [(runs_path, _size(runs_path))]
+            try:
+                # The run start goes first; a run past the end of the columns is simply empty
+                _append_column(runs_path, 'q', [count])
+                _append_column(ts_path, 'q', [row[0] for row in segment_rows])
+                _append_column(val_path, 'd', [row[1] for row in segment_rows])
+                _append_column(id_path, 'q', [row[2] for row in segment_rows])
+            except Exception:
+                _truncate(undo)
+                raise
+            written += len(segment_rows)
+    return written
+
+
+def archived_device_ids():
+    """Return the IDs of all devices that have an archive directory."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return [name for name in os.listdir(ARCHIVE_DIR) if os.path.isdir(os.path.join(ARCHIVE_DIR, name))]
+
+
+def read_range(device_id, start_ts, end_ts):
+    """
+    Read archived measurements for a device in [start_ts, end_ts).
+    Returns a list of (timestamp, measurement_value, id) tuples ordered by timestamp.
+    """
+    start_ts = max(start_ts, 0)
+    end_ts = min(end_ts, MAX_TIMESTAMP + 1)
+    device_dir = os.path.join(ARCHIVE_DIR, str(device_id))
+    if end_ts <= start_ts or not os.path.isdir(device_dir):
+        return []
+
+    first_month, last_month = month_key(start_ts), month_key(end_ts - 1)
+    months = sorted(
+        name[:-len(TIMESTAMP_SUFFIX)] for name in os.listdir(device_dir)
+        if name.endswith(TIMESTAMP_SUFFIX) and first_month <= name[:-len(TIMESTAMP_SUFFIX)] <= last_month
+    )
+
+    result = []
+    for month in months:
+        result.extend(_read_segment(device_id, month, start_ts, end_ts))
+    result.sort(key=lambda row: row[0])
+    return result
+
+
+def _read_segment(device_id, month, start_ts, end_ts):
+    ts_path, val_path, id_path, runs_path = _segment_paths(device_id, month)
+    files = []
+    maps = []
+    views = []
+    rows = []
+    try:
+        with _lock:
+            # Appends only ever grow the files past this row count and compaction
+            # replaces them, so the mapped prefix stays valid after the lock is released
+            _recover_segment(device_id, month)
+            count = _row_count((ts_path, val_path, id_path))
+            if count == 0:
+                return rows
+            runs = sorted(set(_read_column(runs_path, 'q', _size(runs_path) // ITEM_SIZE)) | {0})
+            for path in (ts_path, val_path, id_path):
+                files.append(open(path, 'rb'))
+                maps.append(mmap.mmap(files[-1].fileno(), count * ITEM_SIZE, access=mmap.ACCESS_READ))
+
+        views = [memoryview(maps[0]).cast('q'), memoryview(maps[1]).cast('d'), memoryview(maps[2]).cast('q')]
+        timestamps, values, ids = views
+        bounds = [start for start in runs if start < count] + [count]
+        for run_start, run_end in zip(bounds, bounds[1:]):
+            lo = bisect_left(timestamps, start_ts, run_start, run_end)
+            hi = bisect_left(timestamps, end_ts, lo, run_end)
+            if lo < hi:
+                rows.extend(zip(timestamps[lo:hi].tolist(), values[lo:hi].tolist(), ids[lo:hi].tolist()))
+    finally:
+        for view in views:
+            view.release()
+        for segment_map in maps:
+            segment_map.close()
+        for f in files:
+            f.close()
+    return rows
@@ -1,26 +1,47 @@
 import os
+import uuid
 import psycopg2
 from psycopg2 import sql
-from datetime import datetime
+from psycopg2.extras import execute_values
+from datetime import datetime, timezone
+from archive_module import append_segments, archived_device_ids, read_range
 
 DB_HOST = os.getenv("DB_HOST", "monitoring_db")
 DB_NAME = os.getenv("DB_NAME", "example-db")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASS = os.getenv("DB_PASS", "postgres")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "50000"))
+
+# Errors after which a write can simply be retried once the database is back
+RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+HOUR_MS = 3600000
+DAY_MS = 24 * HOUR_MS
+
+# Advisory lock taken exclusively by each archive batch and shared by aggregate
+# rebuilds, so a rebuild never sees a row both in the archive and in Postgres
+ARCHIVE_LOCK_ID = 720031
 
 import time
 
-def get_connection():
+def get_connection(retry=True):
+    """
+    Open a database connection. With retry=False a failed connect raises
+    OperationalError instead of waiting, so the caller can apply its own backoff.
+    """
     while True:
         try:
             conn = psycopg2.connect(
                 host=DB_HOST,
                 database=DB_NAME,
                 user=DB_USER,
-                password=DB_PASS
+                password=DB_PASS,
+                connect_timeout=5
             )
             return conn
         except psycopg2.OperationalError:
+            if not retry:
+                raise
             print("Database not ready, retrying in 2 seconds...")
             time.sleep(2)
 
@@ -35,6 +56,18 @@ def create_table_if_not_exists():
             measurement_value DOUBLE PRECISION
         )
     """)
+    # A reading is identified by (device_id, timestamp); redelivered messages must not be counted twice
+    cur.execute("SELECT to_regclass('uq_measurements_device_timestamp') IS NULL")
+    if cur.fetchone()[0]:
+        cur.execute("""
+            DELETE FROM measurements a USING measurements b
+            WHERE a.device_id = b.device_id AND a.timestamp = b.timestamp AND a.id > b.id
+        """)
+        cur.execute("""
+            CREATE UNIQUE INDEX uq_measurements_device_timestamp
+            ON measurements (device_id, timestamp)
+        """)
+        cur.execute("DROP INDEX IF EXISTS idx_measurements_device_timestamp")
     cur.execute("""
         CREATE TABLE IF NOT EXISTS hourly_consumption (
             id SERIAL PRIMARY KEY,
@@ -44,65 +77,248 @@ def create_table_if_not_exists():
             UNIQUE(device_id, hour)
         )
     """)
+    cur.execute("SELECT to_regclass('fleet_hourly_consumption') IS NULL, to_regclass('daily_consumption') IS NULL")
+    fleet_missing, daily_missing = cur.fetchone()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fleet_hourly_consumption (
+            hour BIGINT PRIMARY KEY,
+            total_consumption DOUBLE PRECISION
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_consumption (
+            device_id UUID,
+            day BIGINT,
+            total_consumption DOUBLE PRECISION,
+            PRIMARY KEY (device_id, day)
+        )
+    """)
+    # Backfill the rollups from the existing hourly data when they are first created
+    if fleet_missing:
+        cur.execute("""
+            INSERT INTO fleet_hourly_consumption (hour, total_consumption)
+            SELECT hour, SUM(total_consumption) FROM hourly_consumption GROUP BY hour
+        """)
+    if daily_missing:
+        cur.execute("""
+            INSERT INTO daily_consumption (device_id, day, total_consumption)
+            SELECT device_id, (hour / %s) * %s, SUM(total_consumption)
+            FROM hourly_consumption
+            GROUP BY 1, 2
+        """, (DAY_MS, DAY_MS))
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_daily_consumption_day_total
+        ON daily_consumption (day, total_consumption DESC)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS device_owners (
+            user_id UUID,
+            device_id UUID,
+            PRIMARY KEY (user_id, device_id)
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_device_owners_device ON device_owners (device_id)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_hourly_consumption (
+            user_id UUID,
+            hour BIGINT,
+            total_consumption DOUBLE PRECISION,
+            PRIMARY KEY (user_id, hour)
+        )
+    """)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS devices (
             device_id UUID PRIMARY KEY,
             synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    cur.execute("""
+        ALTER TABLE devices ADD COLUMN IF NOT EXISTS max_consumption DOUBLE PRECISION
+    """)
     conn.commit()
     cur.close()
     conn.close()
 
-def insert_device(device_id):
-    """Insert device ID when synchronized from device service."""
+def insert_device(device_id, max_consumption=None):
+    """Insert or update a device when synchronized from device service."""
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("""
-        INSERT INTO devices (device_id)
-        VALUES (%s)
-        ON CONFLICT (device_id) DO NOTHING
-    """, (device_id,))
+        INSERT INTO devices (device_id, max_consumption)
+        VALUES (%s, %s)
+        ON CONFLICT (device_id)
+        DO UPDATE SET max_consumption = COALESCE(EXCLUDED.max_consumption, devices.max_consumption),
+                      synced_at = CURRENT_TIMESTAMP
+    """, (device_id, max_consumption))
     conn.commit()
     cur.close()
     conn.close()
 
 def delete_device(device_id):
-    """Delete device when deleted from device service."""
+    """Delete device (and its ownership) when deleted from device service."""
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("""
         DELETE FROM devices WHERE device_id = %s
     """, (device_id,))
+    _remove_device_owners(cur, "device_id = %s", (device_id,), device_id)
     conn.commit()
     cur.close()
     conn.close()
 
-def insert_measurement(timestamp, device_id, measurement_value):
+# The per-user rollup always equals the sum of the hourly consumption of the
+# user's currently assigned devices: assigning a device adds its history to
+# the user's totals and unassigning it subtracts it again. The SHARE lock on
+# hourly_consumption waits for ingestion batches that read device_owners
+# before the change, so their increments are part of the history moved here;
+# batches that start later see the new owners.
+def _add_owner_history(cur, owners_cte, params, device_id, sign):
+    cur.execute("LOCK TABLE hourly_consumption IN SHARE MODE")
+    cur.execute("""
+        WITH owners AS (""" + owners_cte + """)
+        INSERT INTO user_hourly_consumption (user_id, hour, total_consumption)
+        SELECT owners.user_id, h.hour, %s * h.total_consumption
+        FROM owners JOIN hourly_consumption h ON h.device_id = %s
+        ORDER BY 1, 2
+        ON CONFLICT (user_id, hour)
+        DO UPDATE SET total_consumption = user_hourly_consumption.total_consumption + EXCLUDED.total_consumption
+    """, params + (sign, device_id))
+
+def _remove_device_owners(cur, condition, params, device_id):
+    _add_owner_history(cur, "DELETE FROM device_owners WHERE " + condition + " RETURNING user_id",
+                       params, device_id, -1)
+
+def assign_device_owner(user_id, device_id):
+    """Record that a device belongs to a user and add its history to the user's rollup."""
+    conn = get_connection()
+    cur = conn.cursor()
+    _add_owner_history(cur, """
+        INSERT INTO device_owners (user_id, device_id) VALUES (%s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING user_id
+    """, (user_id, device_id), device_id, 1)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def unassign_device_owner(user_id, device_id):
+    """Remove a device from a user and subtract its history from the user's rollup."""
+    conn = get_connection()
+    cur = conn.cursor()
+    _remove_device_owners(cur, "user_id = %s AND device_id = %s", (user_id, device_id), device_id)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def get_device_limits():
+    """Return {device_id: max_consumption} for every synchronized device with a known limit."""
     conn = get_connection()
     cur = conn.cursor()
-    
-    # Insert raw measurement
     cur.execute("""
-        INSERT INTO measurements (timestamp, device_id, measurement_value)
-        VALUES (%s, %s, %s)
-    """, (timestamp, device_id, measurement_value))
-    
-    # Update hourly consumption
-    # Assuming timestamp is in milliseconds, convert to hour (remove minutes, seconds, millis)
-    # 3600000 ms in an hour
-    hour_timestamp = (timestamp // 3600000) * 3600000
-    
+        SELECT device_id, max_consumption FROM devices WHERE max_consumption IS NOT NULL
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return {str(row[0]): row[1] for row in rows}
+
+def get_hourly_totals(hour):
+    """Return [(device_id, hour, total_consumption), ...] for every device in the given hour."""
+    conn = get_connection()
+    cur = conn.cursor()
     cur.execute("""
-        INSERT INTO hourly_consumption (device_id, hour, total_consumption)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (device_id, hour) 
-        DO UPDATE SET total_consumption = hourly_consumption.total_consumption + EXCLUDED.total_consumption
-    """, (device_id, hour_timestamp, measurement_value))
-    
-    conn.commit()
+        SELECT device_id, hour, total_consumption FROM hourly_consumption WHERE hour = %s
+    """, (hour,))
+    rows = cur.fetchall()
     cur.close()
     conn.close()
+    return [(str(row[0]), row[1], row[2]) for row in rows]
+
+def insert_measurement(timestamp, device_id, measurement_value):
+    insert_measurements([(timestamp, device_id, measurement_value)])
+
+def insert_measurements(rows):
+    """
+    Insert a batch of raw measurements and update the aggregates in one transaction.
+    rows: iterable of (timestamp, device_id, measurement_value).
+    Either the whole batch is committed or nothing is. Readings that are already
+    stored (e.g. redelivered messages) are skipped and do not touch the aggregates.
+    Does not wait for the database: a failed connect raises OperationalError.
+    Returns the indexes (into rows) of the readings that were newly inserted.
+    """
+    inserted = []
+    conn = get_connection(retry=False)
+    cur = conn.cursor()
+    try:
+        for index, (timestamp, device_id, measurement_value) in enumerate(rows):
+            # Insert raw measurement
+            cur.execute("""
+                INSERT INTO measurements (timestamp, device_id, measurement_value)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (device_id, timestamp) DO NOTHING
+                RETURNING id
+            """, (timestamp, device_id, measurement_value))
+            if cur.fetchone() is None:
+                continue
+            inserted.append(index)
+
+            # Update hourly consumption
+            # Assuming timestamp is in milliseconds, convert to hour (remove minutes, seconds, millis)
+            # 3600000 ms in an hour
+            hour_timestamp = (timestamp // 3600000) * 3600000
+
+            cur.execute("""
+                INSERT INTO hourly_consumption (device_id, hour, total_consumption)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (device_id, hour) 
+                DO UPDATE SET total_consumption = hourly_consumption.total_consumption + EXCLUDED.total_consumption
+            """, (device_id, hour_timestamp, measurement_value))
+
+            # Maintain fleet-wide hourly, per-user hourly and per-device daily rollups for the aggregate endpoints
+            cur.execute("""
+                INSERT INTO fleet_hourly_consumption (hour, total_consumption)
+                VALUES (%s, %s)
+                ON CONFLICT (hour)
+                DO UPDATE SET total_consumption = fleet_hourly_consumption.total_consumption + EXCLUDED.total_consumption
+            """, (hour_timestamp, measurement_value))
+
+            cur.execute("""
+                INSERT INTO user_hourly_consumption (user_id, hour, total_consumption)
+                SELECT user_id, %s, %s FROM device_owners WHERE device_id = %s
+                ON CONFLICT (user_id, hour)
+                DO UPDATE SET total_consumption = user_hourly_consumption.total_consumption + EXCLUDED.total_consumption
+            """, (hour_timestamp, measurement_value, device_id))
+
+            cur.execute("""
+                INSERT INTO daily_consumption (device_id, day, total_consumption)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (device_id, day)
+                DO UPDATE SET total_consumption = daily_consumption.total_consumption + EXCLUDED.total_consumption
+            """, (device_id, (timestamp // DAY_MS) * DAY_MS, measurement_value))
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return inserted
+
+def day_bounds(date):
+    """
+    Return (start_ts, end_ts) in milliseconds for a 'YYYY-MM-DD' date (UTC),
+    or None if the date is malformed.
+    Days are UTC everywhere so they line up with the daily_consumption buckets.
+    """
+    try:
+        dt = datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    start_ts = int(dt.timestamp() * 1000)
+    return start_ts, start_ts + DAY_MS
 
 def get_hourly_consumption(device_id, date):
     """
@@ -110,20 +326,15 @@ def get_hourly_consumption(device_id, date):
     date should be a string in 'YYYY-MM-DD' format.
     Returns a list of dictionaries: [{'hour': h, 'total_consumption': val}, ...]
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    
     # Calculate start and end timestamps for the day in milliseconds
-    # Assuming date is 'YYYY-MM-DD'
     # We need to filter by the 'hour' column which is a timestamp (start of the hour)
-    
-    try:
-        dt = datetime.strptime(date, '%Y-%m-%d')
-        start_ts = int(dt.timestamp() * 1000)
-        end_ts = start_ts + (24 * 3600 * 1000)
-    except ValueError:
+    bounds = day_bounds(date)
+    if bounds is None:
         return []
+    start_ts, end_ts = bounds
 
+    conn = get_connection()
+    cur = conn.cursor()
     cur.execute("""
         SELECT hour, total_consumption 
         FROM hourly_consumption 
@@ -142,3 +353,401 @@ def get_hourly_consumption(device_id, date):
             "total_consumption": row[1]
         })
     return result
+
+def get_hourly_consumption_batch(device_ids, dates):
+    """
+    Fetch hourly consumption for several devices and dates with a single query.
+    Malformed dates are skipped.
+    Returns {device_id: {date: [{'hour': h, 'total_consumption': val}, ...]}}
+    """
+    day_starts = {}
+    for date in dates:
+        bounds = day_bounds(date)
+        if bounds is not None:
+            day_starts[bounds[0]] = date
+
+    result = {str(device_id): {date: [] for date in day_starts.values()} for device_id in device_ids}
+    if not result or not day_starts:
+        return result
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT h.device_id, d.day, h.hour, h.total_consumption
+        FROM hourly_consumption h
+        JOIN unnest(%s::bigint[]) AS d(day) ON h.hour >= d.day AND h.hour < d.day + %s
+        WHERE h.device_id = ANY(%s::uuid[])
+        ORDER BY h.device_id, h.hour ASC
+    """, (list(day_starts), DAY_MS, list(result)))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    for device_id, day, hour, total_consumption in rows:
+        result[str(device_id)][day_starts[day]].append({
+            "hour": hour,
+            "total_consumption": total_consumption
+        })
+    return result
+
+def get_fleet_hourly_consumption(date):
+    """
+    Fetch the hourly consumption summed over every device for a date.
+    Served from the precomputed fleet rollup, so the cost is independent of fleet size.
+    Returns a list of dictionaries: [{'hour': h, 'total_consumption': val}, ...]
+    """
+    bounds = day_bounds(date)
+    if bounds is None:
+        return []
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT hour, total_consumption
+        FROM fleet_hourly_consumption
+        WHERE hour >= %s AND hour < %s
+        ORDER BY hour ASC
+    """, bounds)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return [{"hour": row[0], "total_consumption": row[1]} for row in rows]
+
+def get_user_hourly_consumption(user_id, date):
+    """
+    Fetch the hourly consumption summed over all devices of a user for a date.
+    Served from the per-user rollup, so the cost is independent of how many devices the user has.
+    Returns a list of dictionaries: [{'hour': h, 'total_consumption': val}, ...]
+    """
+    bounds = day_bounds(date)
+    if bounds is None:
+        return []
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT hour, total_consumption
+        FROM user_hourly_consumption
+        WHERE user_id = %s AND hour >= %s AND hour < %s
+        ORDER BY hour ASC
+    """, (user_id, bounds[0], bounds[1]))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return [{"hour": row[0], "total_consumption": row[1]} for row in rows]
+
+def get_devices_hourly_consumption(device_ids, date):
+    """
+    Fetch the hourly consumption summed over an arbitrary set of devices for a date.
+    Ad-hoc sets have no rollup, so this is one grouped query whose cost grows with
+    the size of the set; use get_user_hourly_consumption for a user's devices.
+    Returns a list of dictionaries: [{'hour': h, 'total_consumption': val}, ...]
+    """
+    bounds = day_bounds(date)
+    if bounds is None or not device_ids:
+        return []
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT hour, SUM(total_consumption)
+        FROM hourly_consumption
+        WHERE device_id = ANY(%s::uuid[]) AND hour >= %s AND hour < %s
+        GROUP BY hour
+        ORDER BY hour ASC
+    """, (list(device_ids), bounds[0], bounds[1]))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return [{"hour": row[0], "total_consumption": row[1]} for row in rows]
+
+def get_top_consumers(start_date, end_date, limit):
+    """
+    Fetch the devices with the highest consumption between start_date and end_date (inclusive).
+    Served from the per-device daily rollup.
+    Returns a list of dictionaries: [{'device_id': id, 'total_consumption': val}, ...]
+    """
+    start_bounds = day_bounds(start_date)
+    end_bounds = day_bounds(end_date)
+    if start_bounds is None or end_bounds is None:
+        return []
+
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT device_id, SUM(total_consumption) AS total
+        FROM daily_consumption
+        WHERE day >= %s AND day < %s
+        GROUP BY device_id
+        ORDER BY total DESC
+        LIMIT %s
+    """, (start_bounds[0], end_bounds[1], limit))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return [{"device_id": str(row[0]), "total_consumption": row[1]} for row in rows]
+
+def get_raw_measurements(device_id, start_ts, end_ts):
+    """
+    Fetch raw measurements for a device in [start_ts, end_ts) (milliseconds).
+    Cold readings are served from the columnar archive, recent ones from Postgres.
+    A row that is in both tiers (archived but not yet deleted) is returned once.
+    Returns a list of dictionaries: [{'timestamp': t, 'measurement_value': val}, ...]
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT timestamp, measurement_value, id
+        FROM measurements
+        WHERE device_id = %s AND timestamp >= %s AND timestamp < %s
+        ORDER BY timestamp ASC
+    """, (device_id, start_ts, end_ts))
+    recent = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    # Postgres is read before the archive: the archiver appends a row before it
+    # deletes it, so a row moved in between still shows up in the archive read
+    rows = read_range(device_id, start_ts, end_ts)
+    archived_ids = {row[2] for row in rows}
+    rows.extend(row for row in recent if row[2] not in archived_ids)
+
+    rows.sort(key=lambda row: row[0])
+    return [{"timestamp": row[0], "measurement_value": row[1]} for row in rows]
+
+def archive_cold_measurements(cutoff_ts):
+    """
+    Move raw measurements older than cutoff_ts (milliseconds) out of Postgres
+    into the per-device, per-month columnar archive.
+    Works in batches; each batch is appended to the archive first and only
+    deleted from Postgres once the files are synced. Appends are keyed by the
+    measurement id, so a batch that fails (or whose commit outcome is unknown)
+    is simply archived again on the next run without duplicating rows, and
+    readers dedupe rows that are briefly present in both tiers.
+    Returns the number of archived rows.
+    """
+    archived = 0
+    while True:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (ARCHIVE_LOCK_ID,))
+        cur.execute("""
+            SELECT id, timestamp, device_id, measurement_value
+            FROM measurements
+            WHERE timestamp < %s
+            ORDER BY device_id, timestamp
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (cutoff_ts, ARCHIVE_BATCH_SIZE))
+        rows = cur.fetchall()
+        if not rows:
+            conn.rollback()
+            cur.close()
+            conn.close()
+            return archived
+
+        try:
+            append_segments(rows)
+            cur.execute("DELETE FROM measurements WHERE id = ANY(%s)", ([row[0] for row in rows],))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+        archived += len(rows)
+        if len(rows) < ARCHIVE_BATCH_SIZE:
+            return archived
+
+def get_known_device_ids():
+    """
+    Return every device ID that has synchronized metadata, aggregated
+    consumption, raw measurements in Postgres or an archive directory.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT device_id FROM devices
+        UNION
+        SELECT DISTINCT device_id FROM hourly_consumption
+        UNION
+        SELECT DISTINCT device_id FROM measurements
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return sorted({str(row[0]) for row in rows} | set(archived_device_ids()))
+
+def rebuild_aggregates(device_ids, start_ts, end_ts):
+    """
+    Recompute hourly_consumption, daily_consumption and the fleet and user
+    rollups for the given devices in [start_ts, end_ts) from the raw
+    measurements in both Postgres and the archive. start_ts and end_ts must be
+    day-aligned. The rollups are shifted by the difference between the new and
+    old hourly values; use rebuild_rollups to recompute them outright.
+
+    The archived rows are staged before any table lock is taken, so ingestion
+    only waits while the Postgres rows are read and the new values swapped in.
+    Returns the number of hourly rows written.
+    """
+    # Archive directories are named by canonical UUID; any other spelling would
+    # silently rebuild the device from its Postgres rows alone
+    device_ids = [str(uuid.UUID(str(device_id))) for device_id in device_ids]
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        # Keeps the archiver from moving rows between the archive and Postgres mid-rebuild
+        cur.execute("SELECT pg_advisory_xact_lock_shared(%s)", (ARCHIVE_LOCK_ID,))
+
+        cur.execute("""
+            CREATE TEMP TABLE rebuild_measurements (
+                id BIGINT PRIMARY KEY,
+                timestamp BIGINT,
+                device_id UUID,
+                measurement_value DOUBLE PRECISION
+            ) ON COMMIT DROP
+        """)
+        for device_id in device_ids:
+            archived = read_range(device_id, start_ts, end_ts)
+            if archived:
+                execute_values(cur, """
+                    INSERT INTO rebuild_measurements (id, timestamp, device_id, measurement_value) VALUES %s
+                    ON CONFLICT (id) DO NOTHING
+                """, [(measurement_id, timestamp, device_id, value) for timestamp, value, measurement_id in archived])
+
+        # From here on ingestion waits until commit instead of losing increments
+        cur.execute("LOCK TABLE measurements IN SHARE MODE")
+        # Taken before any rollup row, in the same order as owner changes, to avoid deadlocks
+        cur.execute("LOCK TABLE hourly_consumption IN ROW EXCLUSIVE MODE")
+
+        # Rows already archived but not yet deleted from Postgres are counted once
+        cur.execute("""
+            INSERT INTO rebuild_measurements (id, timestamp, device_id, measurement_value)
+            SELECT id, timestamp, device_id, measurement_value
+            FROM measurements
+            WHERE device_id = ANY(%s::uuid[]) AND timestamp >= %s AND timestamp < %s
+            ON CONFLICT (id) DO NOTHING
+        """, (device_ids, start_ts, end_ts))
+
+        cur.execute("""
+            CREATE TEMP TABLE rebuild_hourly ON COMMIT DROP AS
+            SELECT device_id, (timestamp / %s) * %s AS hour, SUM(measurement_value) AS total_consumption
+            FROM rebuild_measurements
+            GROUP BY 1, 2
+        """, (HOUR_MS, HOUR_MS))
+
+        cur.execute("""
+            CREATE TEMP TABLE rebuild_delta ON COMMIT DROP AS
+            SELECT device_id, hour, SUM(delta) AS delta
+            FROM (
+                SELECT device_id, hour, -total_consumption AS delta
+                FROM hourly_consumption
+                WHERE device_id = ANY(%s::uuid[]) AND hour >= %s AND hour < %s
+                UNION ALL
+                SELECT device_id, hour, total_consumption AS delta
+                FROM rebuild_hourly
+            ) changes
+            GROUP BY 1, 2
+        """, (device_ids, start_ts, end_ts))
+
+        cur.execute("""
+            INSERT INTO fleet_hourly_consumption (hour, total_consumption)
+            SELECT hour, SUM(delta)
+            FROM rebuild_delta
+            GROUP BY hour
+            ORDER BY hour
+            ON CONFLICT (hour)
+            DO UPDATE SET total_consumption = fleet_hourly_consumption.total_consumption + EXCLUDED.total_consumption
+        """)
+        cur.execute("""
+            INSERT INTO user_hourly_consumption (user_id, hour, total_consumption)
+            SELECT o.user_id, d.hour, SUM(d.delta)
+            FROM rebuild_delta d
+            JOIN device_owners o ON o.device_id = d.device_id
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+            ON CONFLICT (user_id, hour)
+            DO UPDATE SET total_consumption = user_hourly_consumption.total_consumption + EXCLUDED.total_consumption
+        """)
+
+        cur.execute("""
+            DELETE FROM hourly_consumption
+            WHERE device_id = ANY(%s::uuid[]) AND hour >= %s AND hour < %s
+        """, (device_ids, start_ts, end_ts))
+        cur.execute("""
+            INSERT INTO hourly_consumption (device_id, hour, total_consumption)
+            SELECT device_id, hour, total_consumption FROM rebuild_hourly
+        """)
+        hourly_rows = cur.rowcount
+
+        cur.execute("""
+            DELETE FROM daily_consumption
+            WHERE device_id = ANY(%s::uuid[]) AND day >= %s AND day < %s
+        """, (device_ids, start_ts, end_ts))
+        cur.execute("""
+            INSERT INTO daily_consumption (device_id, day, total_consumption)
+            SELECT device_id, (hour / %s) * %s, SUM(total_consumption)
+            FROM rebuild_hourly
+            GROUP BY 1, 2
+        """, (DAY_MS, DAY_MS))
+
+        conn.commit()
+        return hourly_rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+def rebuild_rollups(start_ts, end_ts):
+    """
+    Recompute fleet_hourly_consumption and user_hourly_consumption in
+    [start_ts, end_ts) as sums over hourly_consumption, after a full-fleet
+    rebuild. The SHARE lock on hourly_consumption waits for in-flight writes
+    and holds back new ones only for the duration of the swap.
+    Returns the number of fleet rows written.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("LOCK TABLE hourly_consumption IN SHARE MODE")
+
+        cur.execute("""
+            DELETE FROM fleet_hourly_consumption WHERE hour >= %s AND hour < %s
+        """, (start_ts, end_ts))
+        cur.execute("""
+            INSERT INTO fleet_hourly_consumption (hour, total_consumption)
+            SELECT hour, SUM(total_consumption)
+            FROM hourly_consumption
+            WHERE hour >= %s AND hour < %s
+            GROUP BY hour
+        """, (start_ts, end_ts))
+        fleet_rows = cur.rowcount
+
+        cur.execute("""
+            DELETE FROM user_hourly_consumption WHERE hour >= %s AND hour < %s
+        """, (start_ts, end_ts))
+        cur.execute("""
+            INSERT INTO user_hourly_consumption (user_id, hour, total_consumption)
+            SELECT o.user_id, h.hour, SUM(h.total_consumption)
+            FROM device_owners o
+            JOIN hourly_consumption h ON h.device_id = o.device_id
+            WHERE h.hour >= %s AND h.hour < %s
+            GROUP BY 1, 2
+        """, (start_ts, end_ts))
+
+        conn.commit()
+        return fleet_rows
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
@@ -0,0 +1,177 @@
+import json
+import queue
+import threading
+import time
+import functools
+import pika
+
+
+class MeasurementPipeline:
+    """
+    Bounded, explicitly acknowledged ingestion pipeline for measurement messages.
+
+    The pika consumer thread only parses messages and puts them into a bounded
+    buffer; a writer thread persists them in batches and acks them afterwards,
+    so nothing is acknowledged before it is committed. The broker prefetch
+    window is the upper bound on in-flight messages and it is halved while
+    database writes are slow, then grown back once they recover.
+    """
+
+    def __init__(self, write, after_write, retryable, max_prefetch=500, min_prefetch=10,
+                 batch_size=100, slow_write_seconds=0.5):
+        # write(batch) must be atomic: it either persists the whole batch or raises.
+        # It returns the measurements that were newly stored; duplicates of
+        # already stored (redelivered) readings are left out.
+        self.write = write
+        # after_write(measurements) runs side effects (broadcasts, alerts) for newly stored readings
+        self.after_write = after_write
+        self.retryable = retryable
+        self.max_prefetch = max_prefetch
+        self.min_prefetch = min_prefetch
+        self.batch_size = batch_size
+        self.slow_write_seconds = slow_write_seconds
+
+        self.buffer = queue.Queue(maxsize=max_prefetch)
+        self.prefetch = max_prefetch
+        self.write_latency = 0.0
+        self.stopping = threading.Event()
+        self.closed = threading.Event()
+        self.connection = None
+        self.channel = None
+        self.writer = None
+
+    def attach(self, connection, channel, queue_name):
+        """Start consuming queue_name with manual acks and launch the writer thread."""
+        self.connection = connection
+        self.channel = channel
+        channel.basic_qos(prefetch_count=self.prefetch)
+        channel.basic_consume(queue=queue_name, on_message_callback=self.on_message, auto_ack=False)
+        self.writer = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+
+    def on_message(self, ch, method, properties, body):
+        try:
+            data = json.loads(body)
+            if not (data.get("timestamp") and data.get("device_id") and data.get("measurement_value") is not None):
+                raise ValueError("missing fields")
+        except Exception as e:
+            print(f" [!] Invalid data format, dropping message: {e}")
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        # Never blocks in practice: the buffer is as large as the biggest prefetch window
+        self.buffer.put((method.delivery_tag, data))
+
+    def publish(self, queue_name, body):
+        """Publish from any thread through the consumer connection."""
+        self._on_connection_thread(functools.partial(
+            self.channel.basic_publish,
+            exchange='',
+            routing_key=queue_name,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=2)
+        ))
+
+    def run_writer(self):
+        while True:
+            try:
+                batch = [self.buffer.get(timeout=0.5)]
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+
+            written = self._write_with_retry([data for _, data in batch])
+            if written:
+                try:
+                    self.after_write(written)
+                except Exception as e:
+                    print(f" [!] Error after writing measurements: {e}")
+
+            # Delivery tags are handled in order by this single writer, so one
+            # cumulative ack covers the whole batch
+            self._on_connection_thread(functools.partial(
+                self.channel.basic_ack, delivery_tag=batch[-1][0], multiple=True))
+
+    def _write_with_retry(self, measurements):
+        """
+        Persist a batch, retrying while the database is unavailable.
+        Rows that fail for non-retryable reasons are isolated and dropped.
+        Returns the measurements that were newly written.
+        """
+        backoff = 1
+        while True:
+            start = time.monotonic()
+            try:
+                written = self.write(measurements)
+                self._record_latency(time.monotonic() - start)
+                return written
+            except self.retryable as e:
+                print(f" [!] Database unavailable, retrying batch of {len(measurements)} in {backoff}s: {e}")
+                # A failing database counts as slow straight away, without smoothing
+                self.write_latency = max(self.write_latency, self.slow_write_seconds * 2)
+                self._adjust_prefetch()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            except Exception as e:
+                if len(measurements) == 1:
+                    print(f" [!] Dropping measurement {measurements[0]}: {e}")
+                    return []
+                written = []
+                for data in measurements:
+                    written.extend(self._write_with_retry([data]))
+                return written
+
+    def _record_latency(self, latency):
+        self.write_latency = 0.8 * self.write_latency + 0.2 * latency
+        self._adjust_prefetch()
+
+    def _adjust_prefetch(self):
+        if self.write_latency > self.slow_write_seconds:
+            prefetch = max(self.min_prefetch, self.prefetch // 2)
+        elif self.write_latency < self.slow_write_seconds / 2:
+            prefetch = min(self.max_prefetch, self.prefetch * 2)
+        else:
+            prefetch = self.prefetch
+
+        if prefetch != self.prefetch:
+            print(f" [*] DB write latency {self.write_latency:.3f}s, prefetch {self.prefetch} -> {prefetch}")
+            self.prefetch = prefetch
+            self._on_connection_thread(functools.partial(self.channel.basic_qos, prefetch_count=prefetch))
+
+    def _on_connection_thread(self, callback):
+        # pika's BlockingConnection is not thread-safe; hand work to its own thread
+        try:
+            self.connection.add_callback_threadsafe(callback)
+        except Exception as e:
+            print(f" [!] Could not schedule RabbitMQ operation: {e}")
+
+    def serve(self):
+        """
+        Run the consumer loop on the calling thread until drain() is requested,
+        then keep servicing acks until the writer has flushed the buffer.
+        """
+        self.channel.start_consuming()
+        while self.writer.is_alive():
+            self.connection.process_data_events(time_limit=0.2)
+        # Deliver the acks queued by the writer's last batch before closing
+        self.connection.process_data_events(time_limit=0)
+        self.connection.close()
+        self.closed.set()
+        print(" [*] Measurement consumer drained and closed.")
+
+    def drain(self, timeout):
+        """Stop taking new messages, flush buffered writes and acks, then return."""
+        if self.connection is None:
+            return
+        print(" [*] Draining measurement pipeline...")
+        self.stopping.set()
+        self._on_connection_thread(self.channel.stop_consuming)
+        deadline = time.monotonic() + timeout
+        self.writer.join(timeout)
+        if self.writer.is_alive() or not self.closed.wait(max(0.0, deadline - time.monotonic())):
+            print(" [!] Drain timed out; unacked messages will be redelivered by RabbitMQ.")
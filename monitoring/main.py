@@ -5,15 +5,33 @@ import time
 import threading
 import asyncio
 from typing import List
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from uuid import UUID
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 import uvicorn
-from database_module import create_table_if_not_exists, insert_measurement, get_hourly_consumption, insert_device, delete_device
+from database_module import create_table_if_not_exists, insert_measurements, get_hourly_consumption, insert_device, delete_device, \
+    get_raw_measurements, archive_cold_measurements, get_device_limits, get_hourly_totals, \
+    get_fleet_hourly_consumption, get_devices_hourly_consumption, get_top_consumers, get_hourly_consumption_batch, \
+    RETRYABLE_ERRORS, assign_device_owner, unassign_device_owner, get_user_hourly_consumption
+from alerting_module import ConsumptionAlertEngine, HOUR_MS
+from ingestion_module import MeasurementPipeline
+from archive_module import MAX_TIMESTAMP
 
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 QUEUE_NAME = "measurements.queue"
 DEVICE_QUEUE_NAME = "device.create.queue"
 DEVICE_DELETE_QUEUE_NAME = "device.delete.queue"
+DEVICE_MAPPING_QUEUE_NAME = "device.mapping.queue"
+ALERT_QUEUE_NAME = "alerts.queue"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+MAX_PREFETCH = int(os.getenv("MAX_PREFETCH", "500"))
+MIN_PREFETCH = int(os.getenv("MIN_PREFETCH", "10"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+SLOW_WRITE_SECONDS = float(os.getenv("SLOW_WRITE_SECONDS", "0.5"))
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "20"))
 
 app = FastAPI()
 
@@ -25,6 +43,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class ConsumptionBatchRequest(BaseModel):
+    device_ids: List[UUID] = Field(..., min_length=1, max_length=500)
+    dates: List[str] = Field(..., min_length=1, max_length=31)
+
 # WebSocket Connection Manager
 class ConnectionManager:
     def __init__(self):
@@ -53,6 +75,47 @@ class ConnectionManager:
                     pass
 
 manager = ConnectionManager()
+alert_engine = ConsumptionAlertEngine()
+
+# Measurement pipeline callbacks
+def write_measurements(measurements):
+    inserted = insert_measurements([
+        (data["timestamp"], data["device_id"], data["measurement_value"]) for data in measurements
+    ])
+    print(f" [x] Saved {len(inserted)} measurements ({len(measurements) - len(inserted)} duplicates skipped)")
+    return [measurements[index] for index in inserted]
+
+def after_write_measurements(measurements):
+    for data in measurements:
+        device_id = data["device_id"]
+
+        # Broadcast to WebSockets
+        # The writer runs in its own thread, so hand the coroutine to uvicorn's main loop
+        if loop:
+            asyncio.run_coroutine_threadsafe(
+                manager.broadcast(json.dumps(data), device_id), loop
+            )
+
+        # Check the running hourly total against the device limit (in memory, no SQL)
+        alert = alert_engine.process(device_id, data["timestamp"], data["measurement_value"])
+        if alert:
+            alert_body = json.dumps(alert)
+            print(f" [!] Device {device_id} exceeded its hourly limit: {alert_body}")
+            measurement_pipeline.publish(ALERT_QUEUE_NAME, alert_body)
+            if loop:
+                asyncio.run_coroutine_threadsafe(
+                    manager.broadcast(alert_body, device_id), loop
+                )
+
+measurement_pipeline = MeasurementPipeline(
+    write=write_measurements,
+    after_write=after_write_measurements,
+    retryable=RETRYABLE_ERRORS,
+    max_prefetch=MAX_PREFETCH,
+    min_prefetch=MIN_PREFETCH,
+    batch_size=WRITE_BATCH_SIZE,
+    slow_write_seconds=SLOW_WRITE_SECONDS
+)
 
 # RabbitMQ Consumer
 def rabbitmq_consumer():
@@ -71,45 +134,12 @@ def rabbitmq_consumer():
 
     channel = connection.channel()
     channel.queue_declare(queue=QUEUE_NAME, durable=True)
+    channel.queue_declare(queue=ALERT_QUEUE_NAME, durable=True)
 
-    def callback(ch, method, properties, body):
-        print(f" [x] Received {body}")
-        try:
-            data = json.loads(body)
-            timestamp = data.get("timestamp")
-            device_id = data.get("device_id")
-            measurement_value = data.get("measurement_value")
-
-            if timestamp and device_id and measurement_value is not None:
-                insert_measurement(timestamp, device_id, measurement_value)
-                print(f" [x] Saved measurement for device {device_id}")
-                
-                # Broadcast to WebSockets
-                # Since this is running in a separate thread, we need to run the async broadcast
-                # We can use a loop or run_coroutine_threadsafe if we had the loop
-                # For simplicity, we can't easily await here without an event loop.
-                # A common pattern is to use a shared queue or just fire and forget if possible,
-                # but here we need to bridge sync to async.
-                # Let's try to get the running loop if possible, or create a new one.
-                # Actually, uvicorn runs the main loop. We can use asyncio.run_coroutine_threadsafe
-                
-                # We need a reference to the main loop. 
-                # Ideally, we should run the consumer as an async task if possible, 
-                # but pika blocking connection is blocking.
-                # We can use a global variable for the loop.
-                if loop:
-                    asyncio.run_coroutine_threadsafe(
-                        manager.broadcast(json.dumps(data), device_id), loop
-                    )
-
-            else:
-                print(" [!] Invalid data format")
-        except Exception as e:
-            print(f" [!] Error processing message: {e}")
-
-    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+    # Messages are acked only after they are committed to the database
+    measurement_pipeline.attach(connection, channel, QUEUE_NAME)
     print(' [*] Waiting for messages.')
-    channel.start_consuming()
+    measurement_pipeline.serve()
 
 # Device RabbitMQ Consumer
 def device_rabbitmq_consumer():
@@ -131,14 +161,31 @@ def device_rabbitmq_consumer():
     def callback(ch, method, properties, body):
         print(f" [x] Received device event: {body}")
         try:
-            # Parse device UUID from message
-            device_id = body.decode('utf-8').strip('"')
-            insert_device(device_id)
+            # Message is either {"id": "...", "consumption": ...} or a bare device UUID
+            message = body.decode('utf-8').strip()
+            max_consumption = None
+            if message.startswith('{'):
+                payload = json.loads(message)
+                device_id = payload.get("id")
+                max_consumption = payload.get("consumption")
+            else:
+                device_id = message.strip('"')
+            insert_device(device_id, max_consumption)
+            if max_consumption is not None:
+                alert_engine.set_limit(device_id, float(max_consumption))
             print(f" [x] Synchronized device {device_id} in monitoring database")
+        except RETRYABLE_ERRORS as e:
+            # Keep the event (e.g. a limit update) for redelivery once the database is back
+            print(f" [!] Database unavailable for device event, requeueing: {e}")
+            time.sleep(2)
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
         except Exception as e:
             print(f" [!] Error processing device event: {e}")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    channel.basic_consume(queue=DEVICE_QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+    # Ack only after the device is stored so events survive a restart
+    channel.basic_consume(queue=DEVICE_QUEUE_NAME, on_message_callback=callback, auto_ack=False)
     print(' [*] Waiting for device events.')
     channel.start_consuming()
 
@@ -165,14 +212,77 @@ def device_delete_rabbitmq_consumer():
             # Parse device UUID from message
             device_id = body.decode('utf-8').strip('"')
             delete_device(device_id)
+            alert_engine.remove_device(device_id)
             print(f" [x] Deleted device {device_id} from monitoring database")
+        except RETRYABLE_ERRORS as e:
+            print(f" [!] Database unavailable for device delete event, requeueing: {e}")
+            time.sleep(2)
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
         except Exception as e:
             print(f" [!] Error processing device delete event: {e}")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    channel.basic_consume(queue=DEVICE_DELETE_QUEUE_NAME, on_message_callback=callback, auto_ack=True)
+    channel.basic_consume(queue=DEVICE_DELETE_QUEUE_NAME, on_message_callback=callback, auto_ack=False)
     print(' [*] Waiting for device delete events.')
     channel.start_consuming()
 
+# Device Mapping RabbitMQ Consumer
+def device_mapping_rabbitmq_consumer():
+    print("Starting Device Mapping RabbitMQ Consumer...")
+    connection = None
+    while connection is None:
+        try:
+            creds = pika.PlainCredentials('kalo', 'kalo')
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=creds)
+            )
+        except pika.exceptions.AMQPConnectionError:
+            print("RabbitMQ not ready for device mapping consumer, retrying...")
+            time.sleep(5)
+
+    channel = connection.channel()
+    channel.queue_declare(queue=DEVICE_MAPPING_QUEUE_NAME, durable=True)
+
+    def callback(ch, method, properties, body):
+        print(f" [x] Received device mapping event: {body}")
+        try:
+            # Message format: {"userId": "...", "deviceId": "...", "action": "assign" | "unassign"}
+            payload = json.loads(body)
+            user_id = payload["userId"]
+            device_id = payload["deviceId"]
+            if payload.get("action") == "unassign":
+                unassign_device_owner(user_id, device_id)
+                print(f" [x] Unassigned device {device_id} from user {user_id}")
+            else:
+                assign_device_owner(user_id, device_id)
+                print(f" [x] Assigned device {device_id} to user {user_id}")
+        except RETRYABLE_ERRORS as e:
+            print(f" [!] Database unavailable for device mapping event, requeueing: {e}")
+            time.sleep(2)
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        except Exception as e:
+            print(f" [!] Error processing device mapping event: {e}")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    channel.basic_consume(queue=DEVICE_MAPPING_QUEUE_NAME, on_message_callback=callback, auto_ack=False)
+    print(' [*] Waiting for device mapping events.')
+    channel.start_consuming()
+
+# Cold Measurement Archiver
+def archive_worker():
+    print("Starting cold measurement archiver...")
+    while True:
+        try:
+            cutoff_ts = int(time.time() * 1000) - ARCHIVE_AFTER_DAYS * 24 * 3600 * 1000
+            archived = archive_cold_measurements(cutoff_ts)
+            if archived:
+                print(f" [x] Archived {archived} measurements older than {ARCHIVE_AFTER_DAYS} days")
+        except Exception as e:
+            print(f" [!] Error archiving measurements: {e}")
+        time.sleep(ARCHIVE_INTERVAL_SECONDS)
+
 # Global loop variable
 loop = None
 
@@ -183,6 +293,10 @@ async def startup_event():
     
     # Initialize DB
     create_table_if_not_exists()
+
+    # Warm the alert engine with device limits and the current hour's totals
+    current_hour = (int(time.time() * 1000) // HOUR_MS) * HOUR_MS
+    alert_engine.load(get_device_limits(), get_hourly_totals(current_hour))
     
     # Start RabbitMQ consumer in a separate thread
     t = threading.Thread(target=rabbitmq_consumer, daemon=True)
@@ -196,6 +310,21 @@ async def startup_event():
     t3 = threading.Thread(target=device_delete_rabbitmq_consumer, daemon=True)
     t3.start()
 
+    # Start cold measurement archiver in a separate thread
+    t4 = threading.Thread(target=archive_worker, daemon=True)
+    t4.start()
+
+    # Start Device Mapping RabbitMQ consumer in a separate thread
+    t5 = threading.Thread(target=device_mapping_rabbitmq_consumer, daemon=True)
+    t5.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # uvicorn turns SIGTERM into a shutdown; flush pending writes and acks before exiting
+    await asyncio.get_running_loop().run_in_executor(
+        None, measurement_pipeline.drain, DRAIN_TIMEOUT_SECONDS
+    )
+
 @app.get("/")
 async def health_check():
     return {"status": "ok"}
@@ -208,6 +337,58 @@ async def get_consumption(device_id: str, date: str):
     """
     return get_hourly_consumption(device_id, date)
 
+@app.post("/consumption/batch", response_class=ORJSONResponse)
+async def get_consumption_batch(request: ConsumptionBatchRequest):
+    """
+    Get hourly consumption for several devices and dates in one round-trip.
+    Body: {"device_ids": ["<uuid>", ...], "dates": ["YYYY-MM-DD", ...]}
+    Returns results grouped per device, then per date.
+    """
+    return ORJSONResponse(get_hourly_consumption_batch(
+        [str(device_id) for device_id in request.device_ids], request.dates))
+
+@app.get("/aggregate/fleet/{date}")
+async def get_fleet_consumption(date: str):
+    """
+    Get hourly consumption summed over all devices on a specific date.
+    Date format: YYYY-MM-DD
+    """
+    return get_fleet_hourly_consumption(date)
+
+@app.get("/aggregate/user/{user_id}/{date}")
+async def get_user_consumption(user_id: UUID, date: str):
+    """
+    Get hourly consumption summed over all devices of a user on a specific date.
+    Date format: YYYY-MM-DD (UTC)
+    """
+    return get_user_hourly_consumption(str(user_id), date)
+
+@app.get("/aggregate/devices/{date}")
+async def get_devices_consumption(date: str, device_ids: List[UUID] = Query(...)):
+    """
+    Get hourly consumption summed over an arbitrary set of devices on a specific date.
+    Usage: /aggregate/devices/2024-01-01?device_ids=<uuid>&device_ids=<uuid>
+    Prefer /aggregate/user for a user's devices; this one scales with the size of the set.
+    """
+    return get_devices_hourly_consumption([str(device_id) for device_id in device_ids], date)
+
+@app.get("/aggregate/top/{start_date}/{end_date}")
+async def get_top_consumption(start_date: str, end_date: str, limit: int = Query(10, ge=1, le=1000)):
+    """
+    Get the top consumers between start_date and end_date (inclusive).
+    Date format: YYYY-MM-DD
+    """
+    return get_top_consumers(start_date, end_date, limit)
+
+@app.get("/measurements/{device_id}")
+async def get_measurements(device_id: UUID, start: int = Query(..., ge=0, le=MAX_TIMESTAMP),
+                           end: int = Query(..., ge=0, le=MAX_TIMESTAMP + 1)):
+    """
+    Get raw measurements for a device between start (inclusive) and end (exclusive).
+    Timestamps are in milliseconds; archived and recent readings are merged.
+    """
+    return get_raw_measurements(str(device_id), start, end)
+
 @app.websocket("/ws/{device_id}")
 async def websocket_endpoint(websocket: WebSocket, device_id: str):
     await manager.connect(websocket, device_id)
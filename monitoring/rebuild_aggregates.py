@@ -0,0 +1,113 @@
+"""
+Rebuild hourly_consumption and its rollups from the raw measurements.
+
+Usage (inside the monitoring-service container):
+    python rebuild_aggregates.py --start 2024-01-01 --end 2024-01-31
+    python rebuild_aggregates.py --start 2024-01-01 --end 2024-01-31 --devices <uuid> <uuid>
+
+The work is split into independent partitions of device ranges and time
+ranges that are rebuilt in parallel. Each partition reads its archived rows
+without blocking ingestion and only holds a table lock while it reads the
+Postgres rows and swaps in the new values, so ingestion pauses briefly per
+partition instead of for the whole rebuild. When all known devices are
+rebuilt, the fleet and user rollups are then recomputed from scratch.
+"""
+import argparse
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database_module import (
+    day_bounds, get_known_device_ids, rebuild_aggregates, rebuild_rollups, RETRYABLE_ERRORS, DAY_MS
+)
+
+MAX_ATTEMPTS = 5
+
+
+def device_id(value):
+    """argparse type: accept any UUID spelling and return its canonical form."""
+    return str(uuid.UUID(value))
+
+
+def build_partitions(device_ids, start_ts, end_ts, devices_per_partition, days_per_partition):
+    """Split the device set and time range into (device_ids, start_ts, end_ts) partitions."""
+    device_ids = sorted(device_ids)
+    device_ranges = [
+        device_ids[i:i + devices_per_partition] for i in range(0, len(device_ids), devices_per_partition)
+    ]
+    step = days_per_partition * DAY_MS
+    time_ranges = [(ts, min(ts + step, end_ts)) for ts in range(start_ts, end_ts, step)]
+    return [(devices, start, end) for devices in device_ranges for start, end in time_ranges]
+
+
+def with_retry(description, rebuild, *args):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return rebuild(*args)
+        except RETRYABLE_ERRORS as e:
+            # Deadlocks and lost connections are transient; every rebuild step is all-or-nothing
+            if attempt == MAX_ATTEMPTS:
+                raise
+            print(f" [!] {description} failed ({e}), retrying...")
+            time.sleep(attempt)
+
+
+def rebuild_partition(partition):
+    device_ids, start_ts, end_ts = partition
+    return with_retry(f"Partition {device_ids[0]}.. {start_ts}-{end_ts}", rebuild_aggregates,
+                      device_ids, start_ts, end_ts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild consumption aggregates from raw measurements.")
+    parser.add_argument("--start", required=True, help="First day to rebuild (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, help="Last day to rebuild, inclusive (YYYY-MM-DD)")
+    parser.add_argument("--devices", nargs="*", type=device_id, help="Device IDs to rebuild (default: all known devices)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of parallel workers")
+    parser.add_argument("--devices-per-partition", type=int, default=100)
+    parser.add_argument("--days-per-partition", type=int, default=7)
+    args = parser.parse_args()
+
+    start_bounds = day_bounds(args.start)
+    end_bounds = day_bounds(args.end)
+    if start_bounds is None or end_bounds is None or end_bounds[1] <= start_bounds[0]:
+        parser.error("--start and --end must be YYYY-MM-DD dates with start <= end")
+
+    # Align to whole days so daily rollups are always recomputed in full
+    start_ts = (start_bounds[0] // DAY_MS) * DAY_MS
+    end_ts = -(-end_bounds[1] // DAY_MS) * DAY_MS
+
+    device_ids = args.devices or get_known_device_ids()
+    if not device_ids:
+        print("No devices to rebuild.")
+        return
+
+    partitions = build_partitions(device_ids, start_ts, end_ts,
+                                  args.devices_per_partition, args.days_per_partition)
+    print(f"Rebuilding {len(device_ids)} devices from {args.start} to {args.end} "
+          f"in {len(partitions)} partitions with {args.workers} workers...")
+
+    hourly_rows = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(rebuild_partition, partition): partition for partition in partitions}
+        for done, future in enumerate(as_completed(futures), start=1):
+            partition_devices, start, end = futures[future]
+            try:
+                hourly_rows += future.result()
+            except Exception as e:
+                failed += 1
+                print(f" [!] Partition {partition_devices[0]}.. {start}-{end} failed: {e}")
+            print(f" [x] {done}/{len(partitions)} partitions done")
+
+    print(f"Rebuild finished: {hourly_rows} hourly rows written, {failed} partitions failed.")
+    if failed:
+        raise SystemExit(1)
+
+    if not args.devices:
+        # The partitions only shifted the rollups; recompute them from the rebuilt hourly rows
+        fleet_rows = with_retry("Rollup rebuild", rebuild_rollups, start_ts, end_ts)
+        print(f"Fleet and user rollups recomputed: {fleet_rows} fleet rows written.")
+
+
+if __name__ == '__main__':
+    main()
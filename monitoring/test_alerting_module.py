@@ -0,0 +1,72 @@
+import unittest
+
+from alerting_module import ConsumptionAlertEngine, HOUR_MS
+
+HOUR = 1000 * HOUR_MS
+
+
+class ConsumptionAlertEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ConsumptionAlertEngine()
+        self.engine.set_limit("d1", 10.0)
+
+    def test_no_alert_without_limit(self):
+        self.assertIsNone(self.engine.process("d2", HOUR, 1000.0))
+
+    def test_alerts_once_when_hourly_total_exceeds_limit(self):
+        self.assertIsNone(self.engine.process("d1", HOUR, 6.0))
+        self.assertIsNone(self.engine.process("d1", HOUR + 1, 4.0))
+
+        alert = self.engine.process("d1", HOUR + 2, 0.5)
+
+        self.assertEqual(alert, {
+            "type": "alert",
+            "device_id": "d1",
+            "hour": HOUR,
+            "total_consumption": 10.5,
+            "max_consumption": 10.0
+        })
+        self.assertIsNone(self.engine.process("d1", HOUR + 3, 5.0))
+
+    def test_new_hour_resets_total_and_alert(self):
+        self.assertIsNotNone(self.engine.process("d1", HOUR, 11.0))
+
+        self.assertIsNone(self.engine.process("d1", HOUR + HOUR_MS, 6.0))
+        alert = self.engine.process("d1", HOUR + HOUR_MS + 1, 6.0)
+
+        self.assertEqual(alert["hour"], HOUR + HOUR_MS)
+        self.assertEqual(alert["total_consumption"], 12.0)
+
+    def test_late_reading_for_previous_hour_is_ignored(self):
+        self.engine.process("d1", HOUR + HOUR_MS, 1.0)
+
+        self.assertIsNone(self.engine.process("d1", HOUR, 100.0))
+        self.assertEqual(self.engine.hourly_totals["d1"], [HOUR + HOUR_MS, 1.0, False])
+
+    def test_load_warms_totals_and_alert_state(self):
+        engine = ConsumptionAlertEngine()
+        engine.load({"d1": 10.0, "d2": 10.0, "d3": None},
+                    [("d1", HOUR, 9.0), ("d2", HOUR, 12.0), ("d3", HOUR, 50.0)])
+
+        # d1 crosses its limit with the next reading, d2 already alerted before the restart
+        self.assertEqual(engine.process("d1", HOUR + 1, 2.0)["total_consumption"], 11.0)
+        self.assertIsNone(engine.process("d2", HOUR + 1, 2.0))
+        self.assertIsNone(engine.process("d3", HOUR + 1, 2.0))
+        self.assertNotIn("d3", engine.limits)
+
+    def test_limit_changes_and_device_removal(self):
+        self.engine.set_limit("d1", 20.0)
+        self.assertIsNone(self.engine.process("d1", HOUR, 15.0))
+
+        self.engine.set_limit("d1", None)
+        self.assertIsNone(self.engine.process("d1", HOUR + 1, 100.0))
+
+        self.engine.set_limit("d1", 5.0)
+        self.engine.remove_device("d1")
+        self.assertNotIn("d1", self.engine.limits)
+        self.assertNotIn("d1", self.engine.hourly_totals)
+
+
+if __name__ == '__main__':
+    unittest.main()
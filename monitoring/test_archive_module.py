@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+import archive_module
+from archive_module import append_segments, archived_device_ids, read_range, MAX_TIMESTAMP
+
+DEVICE = "5b7c3e9a-0d7e-4b1c-9a57-3f1c8f0f2a11"
+
+
+def ms(year, month, day, hour=0):
+    return int(datetime(year, month, day, hour, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def rows(*readings):
+    """Build archive rows from (id, timestamp) pairs; the value is the id as a float."""
+    return [(measurement_id, timestamp, DEVICE, float(measurement_id)) for measurement_id, timestamp in readings]
+
+
+class ArchiveModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(archive_module, "ARCHIVE_DIR", self.archive_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def segment_path(self, month, suffix):
+        return os.path.join(self.archive_dir, DEVICE, month + suffix)
+
+    def ids(self, start_ts=0, end_ts=MAX_TIMESTAMP + 1):
+        return [measurement_id for _, _, measurement_id in read_range(DEVICE, start_ts, end_ts)]
+
+    def test_reappending_overlapping_batch_skips_archived_ids(self):
+        jan = ms(2024, 1, 10)
+        self.assertEqual(append_segments(rows((1, jan), (2, jan + 1), (3, jan + 2))), 3)
+        self.assertEqual(append_segments(rows((2, jan + 1), (3, jan + 2), (4, jan + 3))), 1)
+        self.assertEqual(append_segments(rows((4, jan + 3))), 0)
+
+        self.assertEqual(read_range(DEVICE, jan, jan + 10),
+                         [(jan, 1.0, 1), (jan + 1, 2.0, 2), (jan + 2, 3.0, 3), (jan + 3, 4.0, 4)])
+
+    def test_torn_column_tail_is_ignored_and_repaired(self):
+        jan = ms(2024, 1, 10)
+        append_segments(rows((1, jan), (2, jan + 1), (3, jan + 2)))
+        # Simulate a crash halfway through writing the last value
+        with open(self.segment_path("2024-01", archive_module.VALUE_SUFFIX), "r+b") as f:
+            f.truncate(2 * archive_module.ITEM_SIZE + 4)
+
+        self.assertEqual(self.ids(), [1, 2])
+
+        self.assertEqual(append_segments(rows((2, jan + 1), (3, jan + 2))), 1)
+        self.assertEqual(read_range(DEVICE, jan, jan + 10), [(jan, 1.0, 1), (jan + 1, 2.0, 2), (jan + 2, 3.0, 3)])
+        sizes = {os.path.getsize(self.segment_path("2024-01", suffix))
+                 for suffix in (archive_module.TIMESTAMP_SUFFIX, archive_module.VALUE_SUFFIX, archive_module.ID_SUFFIX)}
+        self.assertEqual(sizes, {3 * archive_module.ITEM_SIZE})
+
+    def test_range_across_months_and_runs(self):
+        # Later batches hold earlier timestamps, so every month has interleaved runs
+        append_segments(rows((1, ms(2024, 1, 20)), (2, ms(2024, 2, 5)), (3, ms(2024, 3, 1))))
+        append_segments(rows((4, ms(2024, 1, 5)), (5, ms(2024, 2, 20)), (6, ms(2024, 1, 31, 23))))
+        append_segments(rows((7, ms(2024, 2, 1)), (8, ms(2024, 1, 25))))
+
+        self.assertEqual(self.ids(), [4, 1, 8, 6, 7, 2, 5, 3])
+        self.assertEqual(self.ids(ms(2024, 1, 20), ms(2024, 2, 20)), [1, 8, 6, 7, 2])
+        self.assertEqual(self.ids(ms(2024, 1, 31, 23), ms(2024, 2, 1) + 1), [6, 7])
+        self.assertEqual(self.ids(ms(2024, 1, 26), ms(2024, 1, 31)), [])
+
+    def test_out_of_range_bounds(self):
+        append_segments(rows((1, ms(2024, 1, 10)), (2, ms(2024, 6, 10))))
+
+        self.assertEqual(self.ids(-10 ** 18, 10 ** 20), [1, 2])
+        self.assertEqual(self.ids(MAX_TIMESTAMP, MAX_TIMESTAMP + 1), [])
+        self.assertEqual(self.ids(ms(2024, 6, 10), ms(2024, 1, 10)), [])
+        self.assertEqual(read_range("unknown-device", 0, MAX_TIMESTAMP + 1), [])
+        self.assertEqual(archived_device_ids(), [DEVICE])
+
+    def test_segment_is_compacted_into_one_run(self):
+        base = ms(2024, 1, 10)
+        with mock.patch.object(archive_module, "MAX_RUNS", 3):
+            for batch in range(5):
+                append_segments(rows((batch, base + 10 - batch)))
+
+        with open(self.segment_path("2024-01", archive_module.RUNS_SUFFIX), "rb") as f:
+            runs = archive_module.array('q', f.read())
+        self.assertLess(len(runs), 3)
+        self.assertEqual(self.ids(), [4, 3, 2, 1, 0])
+        leftovers = [name for name in os.listdir(os.path.join(self.archive_dir, DEVICE))
+                     if name.endswith((archive_module.TMP_SUFFIX, archive_module.COMPACT_SUFFIX))]
+        self.assertEqual(leftovers, [])
+
+    def test_interrupted_compaction_is_rolled_forward(self):
+        base = ms(2024, 1, 10)
+        with mock.patch.object(archive_module, "MAX_RUNS", 2):
+            append_segments(rows((1, base + 2)))
+            append_segments(rows((2, base + 1)))
+            # Crash after the marker is written but before the files are moved into place
+            with mock.patch.object(archive_module, "_recover_segment"):
+                archive_module._compact_segment(DEVICE, "2024-01", 2, [(base, 3.0, 3)])
+
+        self.assertTrue(os.path.exists(self.segment_path("2024-01", archive_module.COMPACT_SUFFIX)))
+        self.assertEqual(self.ids(), [3, 2, 1])
+        self.assertFalse(os.path.exists(self.segment_path("2024-01", archive_module.COMPACT_SUFFIX)))
+
+    def test_uncommitted_compaction_is_discarded(self):
+        jan = ms(2024, 1, 10)
+        append_segments(rows((1, jan)))
+        tmp_path = self.segment_path("2024-01", archive_module.TIMESTAMP_SUFFIX + archive_module.TMP_SUFFIX)
+        with open(tmp_path, "wb") as f:
+            f.write(b"\0" * 64)
+
+        self.assertEqual(self.ids(), [1])
+        self.assertFalse(os.path.exists(tmp_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
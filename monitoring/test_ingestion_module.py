@@ -0,0 +1,206 @@
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from ingestion_module import MeasurementPipeline
+
+
+class FakeConnection:
+    """Runs thread-safe callbacks immediately and lets serve() block until stop_consuming."""
+
+    def __init__(self):
+        self.closed = False
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def process_data_events(self, time_limit=0):
+        time.sleep(time_limit)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeChannel:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acks = []
+        self.qos = []
+        self.published = []
+        self.consuming = threading.Event()
+        self.stopped = threading.Event()
+
+    def basic_qos(self, prefetch_count):
+        self.qos.append(prefetch_count)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        assert auto_ack is False
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        with self.lock:
+            self.acks.append((delivery_tag, multiple))
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body))
+
+    def start_consuming(self):
+        self.consuming.set()
+        self.stopped.wait(5)
+
+    def stop_consuming(self):
+        self.stopped.set()
+
+
+class FakeMethod:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+def measurement(timestamp, device_id="d1", value=1.0):
+    return json.dumps({"timestamp": timestamp, "device_id": device_id, "measurement_value": value}).encode()
+
+
+class MeasurementPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeConnection()
+        self.channel = FakeChannel()
+        self.written = []
+        self.after = []
+
+    def make_pipeline(self, write=None, **kwargs):
+        def default_write(batch):
+            self.written.extend(batch)
+            return batch
+
+        kwargs.setdefault("max_prefetch", 8)
+        kwargs.setdefault("min_prefetch", 1)
+        kwargs.setdefault("batch_size", 4)
+        return MeasurementPipeline(write=write or default_write, after_write=self.after.extend,
+                                   retryable=(OSError,), **kwargs)
+
+    def deliver(self, pipeline, bodies):
+        for tag, body in enumerate(bodies, start=1):
+            pipeline.on_message(self.channel, FakeMethod(tag), None, body)
+
+    def wait_for_ack(self, tag, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.channel.lock:
+                if any(acked >= tag for acked, _ in self.channel.acks):
+                    return
+            time.sleep(0.01)
+        self.fail(f"delivery tag {tag} was never acked")
+
+    def test_acks_cumulatively_only_after_write(self):
+        acks_seen_by_write = []
+
+        def write(batch):
+            acks_seen_by_write.append(list(self.channel.acks))
+            self.written.extend(batch)
+            return batch
+
+        pipeline = self.make_pipeline(write=write)
+        self.deliver(pipeline, [measurement(ts) for ts in range(1, 7)])
+        pipeline.attach(self.connection, self.channel, "q")
+        self.wait_for_ack(6)
+
+        self.assertEqual([data["timestamp"] for data in self.written], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(acks_seen_by_write[0], [])
+        self.assertEqual(self.channel.acks, [(4, True), (6, True)])
+
+    def test_invalid_message_is_acked_and_dropped(self):
+        pipeline = self.make_pipeline()
+        pipeline.on_message(self.channel, FakeMethod(1), None, b"not json")
+        pipeline.on_message(self.channel, FakeMethod(2), None, json.dumps({"device_id": "d1"}).encode())
+
+        self.assertEqual(self.channel.acks, [(1, False), (2, False)])
+        self.assertTrue(pipeline.buffer.empty())
+
+    def test_poison_row_is_isolated(self):
+        def write(batch):
+            if any(data["device_id"] == "bad" for data in batch):
+                raise ValueError("invalid input syntax for type uuid")
+            self.written.extend(batch)
+            return batch
+
+        pipeline = self.make_pipeline(write=write)
+        self.deliver(pipeline, [measurement(1), measurement(2, device_id="bad"), measurement(3)])
+        pipeline.attach(self.connection, self.channel, "q")
+        self.wait_for_ack(3)
+
+        self.assertEqual([data["timestamp"] for data in self.written], [1, 3])
+        self.assertEqual([data["timestamp"] for data in self.after], [1, 3])
+        self.assertEqual(self.channel.acks, [(3, True)])
+
+    def test_duplicates_are_acked_without_side_effects(self):
+        pipeline = self.make_pipeline(write=lambda batch: [])
+        self.deliver(pipeline, [measurement(1), measurement(1)])
+        pipeline.attach(self.connection, self.channel, "q")
+        self.wait_for_ack(2)
+
+        self.assertEqual(self.after, [])
+
+    def test_database_outage_shrinks_prefetch_and_retries(self):
+        failures = [2]
+
+        def write(batch):
+            if failures[0]:
+                failures[0] -= 1
+                raise OSError("connection refused")
+            self.written.extend(batch)
+            return batch
+
+        pipeline = self.make_pipeline(write=write)
+        self.deliver(pipeline, [measurement(1)])
+        with mock.patch("ingestion_module.time.sleep"):
+            pipeline.attach(self.connection, self.channel, "q")
+            self.wait_for_ack(1)
+
+        self.assertEqual(self.channel.qos[:3], [8, 4, 2])
+        self.assertEqual(len(self.written), 1)
+
+    def test_prefetch_grows_back_once_writes_are_fast(self):
+        pipeline = self.make_pipeline()
+        pipeline.connection = self.connection
+        pipeline.channel = self.channel
+        pipeline.prefetch = 1
+        pipeline.write_latency = 0.0
+
+        for _ in range(4):
+            pipeline._record_latency(0.01)
+
+        self.assertEqual(self.channel.qos, [2, 4, 8])
+        self.assertEqual(pipeline.prefetch, 8)
+
+    def test_drain_flushes_buffer_and_closes(self):
+        release = threading.Event()
+
+        def write(batch):
+            release.wait(5)
+            self.written.extend(batch)
+            return batch
+
+        pipeline = self.make_pipeline(write=write)
+        self.deliver(pipeline, [measurement(ts) for ts in range(1, 4)])
+        pipeline.attach(self.connection, self.channel, "q")
+        server = threading.Thread(target=pipeline.serve)
+        server.start()
+        self.channel.consuming.wait(5)
+
+        drainer = threading.Thread(target=pipeline.drain, args=(5,))
+        drainer.start()
+        release.set()
+        drainer.join(10)
+        server.join(10)
+
+        self.assertTrue(self.channel.stopped.is_set())
+        self.assertEqual(len(self.written), 3)
+        self.assertEqual(self.channel.acks[-1], (3, True))
+        self.assertTrue(self.connection.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()